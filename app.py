@@ -1,90 +1,432 @@
 import os
+
+# one BLAS/OpenMP thread per worker: single-row predictions gain nothing from
+# threading and multiple workers would contend for cores. Must be set before
+# numpy/sklearn are imported; batch/offline jobs may want to override these.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+import asyncio
+import hashlib
+import json
+import math
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
+from typing import Annotated, List
 
 import joblib
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import numpy as np
+from threadpoolctl import threadpool_limits
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict, Field
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from google.oauth2 import service_account
+
+try:
+    import m2cgen
+except ImportError:  # serve the sklearn estimator directly
+    m2cgen = None
+
+try:
+    import onnxruntime as ort
+except ImportError:  # fall back to joblib + sklearn
+    ort = None
+
+# also caps pools already initialised by libraries that ignore the env vars
+threadpool_limits(1)
 
 # ==========================================================
 # CONFIG
 # ==========================================================
-SERVICE_ACCOUNT_KEY = "github-dvc-key.json"  # must be in repo/VM
+SERVICE_ACCOUNT_KEY = "github-dvc-key.json"  # optional; falls back to ADC
 BUCKET_NAME = "mlops-course-phonic-axle-473506-u8-unique"
 # this is where DVC stored your model in GCS
 GCS_MODEL_BLOB = "dvcstore/files/md5/b5/0729b0bfd352c510335b6e0c71b236"
+# DVC addresses blobs by content, so the path spells out the file's MD5
+MODEL_MD5 = "".join(GCS_MODEL_BLOB.split("/")[-2:])
 LOCAL_MODEL_PATH = Path("models/model.pkl")
+# produced by export_onnx.py; preferred over the pickle when present
+LOCAL_ONNX_PATH = Path("models/model.onnx")
 
-app = FastAPI(
-    title="Iris Species Prediction API",
-    description="Predict iris species using model downloaded from GCS",
-    version="1.0.0",
-)
+SPECIES_MAP = {0: "setosa", 1: "versicolor", 2: "virginica"}
+
+# rows used to check the m2cgen export against sklearn at load time
+PROBE_ROWS = 256
+
+# parallel ranged GETs for the model download
+DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+DOWNLOAD_MAX_WORKERS = 8
+
+# micro-batching: concurrent /predict calls are scored in one model.predict
+N_FEATURES = 4
+MAX_BATCH_SIZE = 32
+BATCH_TIMEOUT_MS = 5
+
+# cap on rows per /predict_batch request
+MAX_PREDICT_BATCH = 1024
+
+# response cache: repeated payloads skip the model
+RESPONSE_CACHE_SIZE = 4096
 
 model = None  # will be loaded at startup
+postprocess = None  # raw prediction -> (predicted_label, species), bound at startup
+
+# built once; fires on every request while a pod is still warming up
+NOT_READY_EXC = HTTPException(status_code=503, detail="Model not loaded. Try again later.")
+
+# float32 features -> (predicted_label, species); only touched on the event
+# loop, so no lock is needed. Cleared whenever a model is loaded.
+response_cache = OrderedDict()
+
+batch_queue = None  # created at startup, on the serving event loop
+batch_task = None
+# single thread so prediction runs off the event loop; sklearn/onnxruntime
+# release the GIL in C code, the m2cgen-generated Python does not
+predict_executor = ThreadPoolExecutor(max_workers=1)
 
 
 # ==========================================================
 # INPUT SCHEMA
 # ==========================================================
+# finite and within float32 range: the model scores float32, where larger
+# values become inf, and NaN/inf are rejected (sklearn) or misrouted (m2cgen)
+FEATURE_MAX = float(np.finfo(np.float32).max)
+Feature = Annotated[float, Field(allow_inf_nan=False, ge=-FEATURE_MAX, le=FEATURE_MAX)]
+
+
 class IrisInput(BaseModel):
-    sepal_length: float
-    sepal_width: float
-    petal_length: float
-    petal_width: float
+    # validated by pydantic-core (Rust); unknown fields are rejected
+    model_config = ConfigDict(extra="forbid")
+
+    sepal_length: Feature
+    sepal_width: Feature
+    petal_length: Feature
+    petal_width: Feature
 
 
 # ==========================================================
 # HELPERS
 # ==========================================================
+class OnnxModel:
+    """
+    Serves an ONNX export of the sklearn model through onnxruntime,
+    behind the same predict(X) -> labels interface.
+    """
+
+    def __init__(self, path):
+        opts = ort.SessionOptions()
+        # tiny inputs: intra-op threading only adds overhead
+        opts.intra_op_num_threads = 1
+        opts.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(path), sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        # first output is the predicted label; skip computing probabilities
+        self.label_name = self.session.get_outputs()[0].name
+        # written by export_onnx.py, mirrors the sklearn estimator's classes_
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.classes_ = np.asarray(json.loads(meta["classes"])) if "classes" in meta else None
+        # MD5 of the model.pkl it was exported from
+        self.source_md5 = meta.get("source_md5")
+
+    def predict(self, X):
+        return self.session.run([self.label_name], {self.input_name: X})[0]
+
+
+class GeneratedModel:
+    """
+    Runs the sklearn model as straight-line Python emitted by m2cgen at load
+    time, skipping numpy/sklearn dispatch, behind the same predict(X) -> labels
+    interface.
+    """
+
+    def __init__(self, mdl):
+        ns = {}
+        exec(m2cgen.export_to_python(mdl), ns)
+        self.score = ns["score"]
+        self.classes_ = mdl.classes_
+        # binary linear models emit one decision value instead of per-class scores
+        self.scalar_score = not isinstance(self.score([0.0] * N_FEATURES), list)
+
+        # the export can be subtly off for some estimators: refuse to serve it
+        # unless it reproduces sklearn on a fixed set of probe rows
+        probe = np.random.default_rng(0).uniform(0, 8, (PROBE_ROWS, N_FEATURES)).astype(np.float32)
+        if not np.array_equal(self.predict(probe), mdl.predict(probe)):
+            raise ValueError("generated code disagrees with the sklearn model")
+
+    def predict(self, X):
+        # NaN fails every `<=` in the generated code and lands in the wrong
+        # branch (sklearn routes it by sample count); reject non-finite input
+        # like sklearn does rather than return a different answer
+        if not np.isfinite(X).all():
+            raise ValueError("Input X contains NaN or infinity")
+        scores = map(self.score, X.tolist())
+        if self.scalar_score:
+            idx = [int(s > 0) for s in scores]
+        else:
+            # per-class scores; max() keeps the first argmax like numpy
+            idx = [max(range(len(p)), key=p.__getitem__) for p in scores]
+        return self.classes_[idx]
+
+
+@lru_cache(maxsize=None)
+def get_bucket():
+    """
+    Builds the storage client and bucket handle once and reuses them.
+    Uses the service account key if present, else Application Default Credentials.
+    """
+    if os.path.exists(SERVICE_ACCOUNT_KEY):
+        creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_KEY)
+        client = storage.Client(project=creds.project_id, credentials=creds)
+    else:
+        client = storage.Client()
+    return client.bucket(BUCKET_NAME)
+
+
+def file_md5(path):
+    """
+    Hex MD5 of a file, read in 1 MiB chunks.
+    """
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def download_model_from_gcs():
     """
-    Downloads the model from GCS to local models/model.pkl
+    Downloads the model from GCS to local models/model.pkl,
+    using concurrent ranged GETs.
+    Each process downloads to its own temp file, checks it against MODEL_MD5
+    and renames it into place, so concurrent workers on a cold start never
+    write to the same file and model.pkl is never seen half-written.
     """
     # make sure models/ exists
     LOCAL_MODEL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=LOCAL_MODEL_PATH.parent, suffix=".part")
+    os.close(fd)
+    tmp_path = Path(tmp_name)
 
-    # set creds for google client
-    if os.path.exists(SERVICE_ACCOUNT_KEY):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_KEY
-    else:
-        raise FileNotFoundError(
-            f"Service account JSON '{SERVICE_ACCOUNT_KEY}' not found in current dir."
+    try:
+        blob = get_bucket().blob(GCS_MODEL_BLOB)
+        # threads rather than processes: no pickling of the client, no fork
+        transfer_manager.download_chunks_concurrently(
+            blob,
+            str(tmp_path),
+            chunk_size=DOWNLOAD_CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=DOWNLOAD_MAX_WORKERS,
         )
 
-    client = storage.Client()
-    bucket = client.bucket(BUCKET_NAME)
-    blob = bucket.blob(GCS_MODEL_BLOB)
-    blob.download_to_filename(LOCAL_MODEL_PATH)
+        if file_md5(tmp_path) != MODEL_MD5:
+            raise ValueError(f"Downloaded model does not match MD5 {MODEL_MD5}")
+        os.replace(tmp_path, LOCAL_MODEL_PATH)
+    finally:
+        # only left behind if the download or the MD5 check failed
+        tmp_path.unlink(missing_ok=True)
     print("✅ Model downloaded from GCS →", LOCAL_MODEL_PATH)
 
 
 def load_model():
     """
-    Ensures model is present locally and loads it with joblib.
+    Loads the ONNX export with onnxruntime if available and it was exported
+    from the pickle matching MODEL_MD5. Otherwise ensures model.pkl is present
+    locally and matches MODEL_MD5 (downloading it from GCS if not), loads it
+    with joblib and compiles it to plain Python with m2cgen when possible.
     """
+    if ort is not None and LOCAL_ONNX_PATH.exists():
+        mdl = OnnxModel(LOCAL_ONNX_PATH)
+        if mdl.source_md5 == MODEL_MD5:
+            print("✅ ONNX model loaded into memory.")
+            return mdl
+        print("⚠️ model.onnx was not exported from the current model.pkl; ignoring it.")
+
     if not LOCAL_MODEL_PATH.exists():
         print("⏳ model.pkl not found locally. Downloading from GCS...")
         download_model_from_gcs()
+    elif file_md5(LOCAL_MODEL_PATH) != MODEL_MD5:
+        print("⏳ model.pkl is stale or corrupted (MD5 mismatch). Downloading from GCS...")
+        download_model_from_gcs()
 
-    mdl = joblib.load(LOCAL_MODEL_PATH)
+    # mmap the estimator's numpy arrays so workers share them via the page
+    # cache; the loaded model is read-only (inference only, no fit/partial_fit)
+    mdl = joblib.load(LOCAL_MODEL_PATH, mmap_mode="r")
     print("✅ Model loaded into memory.")
+
+    if m2cgen is not None:
+        try:
+            mdl = GeneratedModel(mdl)
+            print("✅ Model compiled to Python with m2cgen.")
+        except Exception as e:
+            # unsupported estimator (or too deep to compile): keep sklearn
+            print(f"⚠️ m2cgen could not compile the model, using sklearn: {e}")
     return mdl
 
 
+def make_postprocess(mdl):
+    """
+    Decides once, from the model's classes_, how a raw prediction maps to
+    (predicted_label, species), so predict() needs no per-request type checks.
+    """
+    classes = getattr(mdl, "classes_", None)
+    if classes is None:
+        # label type unknown up front: check each prediction
+        return lambda y: (y, y) if isinstance(y, str) else (int(y), SPECIES_MAP.get(int(y), "unknown"))
+    if classes.dtype.kind in "UO":
+        # model returns string labels like "setosa"
+        return lambda y: (y, y)
+
+    # integer labels: species resolved once per class the model can emit
+    species = {int(c): SPECIES_MAP.get(int(c), "unknown") for c in classes}
+    return lambda y: (int(y), species[int(y)])
+
+
+def rows_to_array(rows):
+    """
+    Packs feature tuples into one (n, 4) float32 array. sklearn trees work in
+    float32, so check_array neither re-parses Python lists nor copies to float64.
+    """
+    return np.fromiter(
+        chain.from_iterable(rows),
+        dtype=np.float32,
+        count=len(rows) * N_FEATURES,
+    ).reshape(-1, N_FEATURES)
+
+
+async def batch_worker():
+    """
+    Drains up to MAX_BATCH_SIZE queued rows, predicts them in one call and
+    resolves each future. A lone request is scored immediately; when several
+    are queued, it waits up to BATCH_TIMEOUT_MS for more to join.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        # take whatever queued up while the previous batch was predicting
+        while len(batch) < MAX_BATCH_SIZE and not batch_queue.empty():
+            batch.append(batch_queue.get_nowait())
+
+        # a lone request is dispatched at once; only under load (others were
+        # already waiting) is it worth holding the batch open for stragglers
+        deadline = loop.time() + BATCH_TIMEOUT_MS / 1000
+        while 1 < len(batch) < MAX_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        X = rows_to_array([row for row, _ in batch])
+        try:
+            preds = await loop.run_in_executor(predict_executor, model.predict, X)
+        except Exception:
+            # one bad row must not fail the requests batched with it: rescore
+            # row by row so only the failing row's future gets the error
+            for row, fut in batch:
+                try:
+                    single = rows_to_array([row])
+                    y = (await loop.run_in_executor(predict_executor, model.predict, single))[0]
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(y)
+            continue
+
+        for (_, fut), y in zip(batch, preds):
+            if not fut.done():
+                fut.set_result(y)
+
+
+async def batched_predict(row):
+    """
+    Queues a single feature row for the batch worker and waits for its prediction.
+    """
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((row, fut))
+    return await fut
+
+
+async def cached_predict(row):
+    """
+    Returns (predicted_label, species) for a feature row, serving repeats
+    from the LRU response cache and batching the misses. The key is the
+    float32 cast of the row: that is all the model ever sees, so two inputs
+    sharing a key always get the same prediction.
+    """
+    key = tuple(map(np.float32, row))
+    hit = response_cache.get(key)
+    if hit is not None:
+        response_cache.move_to_end(key)
+        return hit
+
+    result = postprocess(await batched_predict(row))
+    response_cache[key] = result
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+    return result
+
+
 # ==========================================================
 # STARTUP
 # ==========================================================
-@app.on_event("startup")
-def on_startup():
-    global model
+@asynccontextmanager
+async def lifespan(app):
+    global model, postprocess, batch_queue, batch_task
+    batch_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_worker())
     try:
-        model = load_model()
+        # download + unpickle off the event loop
+        model = await asyncio.to_thread(load_model)
+        postprocess = make_postprocess(model)
+        response_cache.clear()
     except Exception as e:
         # don’t crash the app, but log the error
         print(f"⚠️ Could not load model on startup: {e}")
         model = None
 
+    yield
+
+    batch_task.cancel()
+
+
+app = FastAPI(
+    title="Iris Species Prediction API",
+    description="Predict iris species using model downloaded from GCS",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    """
+    Same 422 body as FastAPI's default handler, except rejected NaN/inf
+    inputs are echoed back as strings (they can't be encoded as JSON).
+    """
+    errors = [
+        {**err, "input": str(err["input"])}
+        if isinstance(err.get("input"), float) and not math.isfinite(err["input"])
+        else err
+        for err in exc.errors()
+    ]
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
+
 
 # ==========================================================
 # ROUTES
@@ -95,31 +437,25 @@ def root():
 
 
 @app.post("/predict")
-def predict(features: IrisInput):
+async def predict(features: IrisInput):
     global model
     if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded. Try again later.")
+        # drop the previous raise's traceback so it doesn't keep growing
+        raise NOT_READY_EXC.with_traceback(None)
 
-    X = [[
+    row = (
         features.sepal_length,
         features.sepal_width,
         features.petal_length,
         features.petal_width,
-    ]]
+    )
 
     try:
-        y_pred = model.predict(X)[0]
-
-        # If model returns string labels like "setosa"
-        if isinstance(y_pred, str):
-            species = y_pred
-        else:
-            label_map = {0: "setosa", 1: "versicolor", 2: "virginica"}
-            species = label_map.get(int(y_pred), "unknown")
+        label, species = await cached_predict(row)
 
         return {
             "status": "success",
-            "predicted_label": y_pred,
+            "predicted_label": label,
             "species": species
         }
 
@@ -127,6 +463,38 @@ def predict(features: IrisInput):
         raise HTTPException(status_code=500, detail=f"Prediction failed: {e}")
 
 
+@app.post("/predict_batch")
+async def predict_batch(
+    items: Annotated[List[IrisInput], Field(min_length=1, max_length=MAX_PREDICT_BATCH)],
+):
+    """
+    Scores many rows with a single model.predict call; for callers that
+    already hold a batch (single rows still go through /predict).
+    """
+    if model is None:
+        raise NOT_READY_EXC.with_traceback(None)
+
+    X = rows_to_array([
+        (f.sepal_length, f.sepal_width, f.petal_length, f.petal_width) for f in items
+    ])
+
+    try:
+        loop = asyncio.get_running_loop()
+        preds = await loop.run_in_executor(predict_executor, model.predict, X)
+
+        predictions = []
+        for y in preds:
+            label, species = postprocess(y)
+            predictions.append({"predicted_label": label, "species": species})
+
+        return {
+            "status": "success",
+            "predictions": predictions,
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Prediction failed: {e}")
+
 
 # ==========================================================
 # MAIN (so you can run: python app.py)
@@ -134,10 +502,21 @@ def predict(features: IrisInput):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(
-        "app:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,  # nice for local/dev
-    )
+    if os.getenv("DEV"):
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,  # nice for local/dev
+        )
+    else:
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+            loop="uvloop",
+            http="httptools",
+            access_log=False,  # no synchronous log write per request
+        )
 
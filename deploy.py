@@ -1,45 +1,91 @@
+import os
+
+# ===== thread limits (before numpy/sklearn load) =====
+# gunicorn workers each get one BLAS/OpenMP thread so they don't fight over
+# cores; set these in the environment to override for batch-heavy use
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 from fastapi import FastAPI, Request, HTTPException, Response, status
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-import logging, json, time, joblib
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import chain
+from typing import Annotated, List
+import asyncio, logging, math, time, joblib
+import numpy as np
+from pythonjsonlogger.orjson import OrjsonFormatter
+from threadpoolctl import threadpool_limits
+
+try:
+    import m2cgen
+except ImportError:  # serve the sklearn estimator directly
+    m2cgen = None
 
 # opentelemetry
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
 
+# covers thread pools that were started before the env vars were read
+threadpool_limits(1)
+
 # ===== OTel setup =====
-trace.set_tracer_provider(TracerProvider())
+# proxy tracer; spans go to the real provider once setup_tracing() has run
 tracer = trace.get_tracer(__name__)
-span_processor = BatchSpanProcessor(CloudTraceSpanExporter())
-trace.get_tracer_provider().add_span_processor(span_processor)
+
+def setup_tracing():
+    # called per worker (from lifespan), not at import: the exporter's gRPC
+    # channel must not be created in a gunicorn --preload master before fork
+    # only OTEL_SAMPLE_RATIO of root traces are recorded/exported (default 1%)
+    sampler = ParentBased(TraceIdRatioBased(float(os.getenv("OTEL_SAMPLE_RATIO", "0.01"))))
+    provider = TracerProvider(sampler=sampler)
+    provider.add_span_processor(BatchSpanProcessor(
+        CloudTraceSpanExporter(),
+        max_queue_size=2048,
+        max_export_batch_size=512,
+        schedule_delay_millis=5000,
+    ))
+    trace.set_tracer_provider(provider)
 
 # ===== logging setup =====
 logger = logging.getLogger("iris-ml-service")
 logger.setLevel(logging.INFO)
 handler = logging.StreamHandler()
-formatter = logging.Formatter(json.dumps({
-    "severity": "%(levelname)s",
-    "message": "%(message)s",
-    "timestamp": "%(asctime)s"
-}))
+# records are rendered to JSON once, here; `extra` fields become top-level keys
+formatter = OrjsonFormatter(
+    "%(levelname)s %(message)s %(asctime)s",
+    rename_fields={"levelname": "severity", "asctime": "timestamp"},
+)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-app = FastAPI(title="Iris classifier with telemetry")
-
 # service state
 app_state = {"is_ready": False, "is_alive": True}
 
 # pydantic schema
+# features must be finite and fit in float32, the dtype the model scores in
+FEATURE_MAX = float(np.finfo(np.float32).max)
+Feature = Annotated[float, Field(allow_inf_nan=False, ge=-FEATURE_MAX, le=FEATURE_MAX)]
+
 class Input(BaseModel):
-    sepal_length: float
-    sepal_width: float
-    petal_length: float
-    petal_width: float
+    # validated by pydantic-core (Rust); unknown fields are rejected
+    model_config = ConfigDict(extra="forbid")
+
+    sepal_length: Feature
+    sepal_width: Feature
+    petal_length: Feature
+    petal_width: Feature
 
 model = None
+postprocess = None  # raw prediction -> species, bound once the model is loaded
 
 SPECIES_MAP = {
     0: "setosa",
@@ -47,49 +93,233 @@ SPECIES_MAP = {
     2: "virginica",
 }
 
-@app.on_event("startup")
-async def startup_event():
-    global model
+# ===== model =====
+N_FEATURES = 4
+# rows used to check the m2cgen export against sklearn at load time
+PROBE_ROWS = 256
+
+class GeneratedModel:
+    # the sklearn model as straight-line Python emitted by m2cgen at load
+    # time: no numpy/sklearn dispatch per call, same predict(X) -> labels
+    def __init__(self, mdl):
+        ns = {}
+        exec(m2cgen.export_to_python(mdl), ns)
+        self.score = ns["score"]
+        self.classes_ = mdl.classes_
+        # binary linear models emit one decision value, not per-class scores
+        self.scalar_score = not isinstance(self.score([0.0] * N_FEATURES), list)
+
+        # only serve the export if it reproduces sklearn on fixed probe rows
+        probe = np.random.default_rng(0).uniform(0, 8, (PROBE_ROWS, N_FEATURES)).astype(np.float32)
+        if not np.array_equal(self.predict(probe), mdl.predict(probe)):
+            raise ValueError("generated code disagrees with the sklearn model")
+
+    def predict(self, X):
+        # the probe only covers finite rows, and the generated branches would
+        # silently misroute NaN/inf; reject them the way sklearn does
+        if not np.isfinite(X).all():
+            raise ValueError("Input X contains NaN or infinity")
+        scores = map(self.score, X.tolist())
+        if self.scalar_score:
+            idx = [int(s > 0) for s in scores]
+        else:
+            # per-class scores; max() keeps the first argmax like numpy
+            idx = [max(range(len(p)), key=p.__getitem__) for p in scores]
+        return self.classes_[idx]
+
+def make_postprocess(mdl):
+    # decide string vs integer labels once from classes_, not per request
+    classes = getattr(mdl, "classes_", None)
+    if classes is None:
+        return lambda y: y if isinstance(y, str) else SPECIES_MAP.get(int(y), str(y))
+    if classes.dtype.kind in "UO":
+        return lambda y: y
+    species = {int(c): SPECIES_MAP.get(int(c), str(int(c))) for c in classes}
+    return lambda y: species[int(y)]
+
+# ===== micro-batching =====
+# concurrent /predict calls are queued and scored together in one model.predict
+MAX_BATCH_SIZE = 32
+BATCH_TIMEOUT_MS = 5
+# cap on rows per /predict_batch request
+MAX_PREDICT_BATCH = 1024
+
+batch_queue = None
+batch_task = None
+# single thread so prediction runs off the event loop (sklearn releases the
+# GIL in C code; the m2cgen-generated Python holds it)
+predict_executor = ThreadPoolExecutor(max_workers=1)
+
+def rows_to_array(rows):
+    # one (n, 4) float32 buffer: sklearn trees work in float32, so check_array
+    # neither re-parses Python lists nor copies to float64
+    return np.fromiter(
+        chain.from_iterable(rows),
+        dtype=np.float32,
+        count=len(rows) * N_FEATURES,
+    ).reshape(-1, N_FEATURES)
+
+async def batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        # take whatever queued up while the previous batch was predicting
+        while len(batch) < MAX_BATCH_SIZE and not batch_queue.empty():
+            batch.append(batch_queue.get_nowait())
+
+        # a lone request is dispatched at once; only under load (others were
+        # already waiting) is it worth holding the batch open for stragglers
+        deadline = loop.time() + BATCH_TIMEOUT_MS / 1000
+        while 1 < len(batch) < MAX_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        X = rows_to_array([row for row, _ in batch])
+        try:
+            preds = await loop.run_in_executor(predict_executor, model.predict, X)
+        except Exception:
+            # one bad row must not fail the requests batched with it: rescore
+            # row by row so only the failing row's future gets the error
+            for row, fut in batch:
+                try:
+                    single = rows_to_array([row])
+                    y = (await loop.run_in_executor(predict_executor, model.predict, single))[0]
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(y)
+            continue
+
+        for (_, fut), y in zip(batch, preds):
+            if not fut.done():
+                fut.set_result(y)
+
+async def batched_predict(row):
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((row, fut))
+    return await fut
+
+# ===== response cache =====
+# repeated payloads skip the model entirely; keyed on the float32 cast of the
+# row, which is exactly what the model sees, so a hit never changes the answer.
+# Only touched on the event loop, so no lock is needed.
+RESPONSE_CACHE_SIZE = 4096
+response_cache = OrderedDict()
+
+async def cached_predict(row):
+    key = tuple(map(np.float32, row))
+    hit = response_cache.get(key)
+    if hit is not None:
+        response_cache.move_to_end(key)
+        return hit
+
+    species = postprocess(await batched_predict(row))
+    response_cache[key] = species
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+    return species
+
+def load_model():
+    global model, postprocess
     try:
         logger.info("Loading model from models/model.pkl ...")
-        model = joblib.load("models/model.pkl")
+        # memory-mapped and read-only: shared across workers, inference only
+        model = joblib.load("models/model.pkl", mmap_mode="r")
+        if m2cgen is not None:
+            try:
+                model = GeneratedModel(model)
+                logger.info("✅ Model compiled to Python with m2cgen.")
+            except Exception as e:
+                # unsupported estimator (or too deep to compile): keep sklearn
+                logger.warning(f"m2cgen could not compile the model, using sklearn: {e}")
+        postprocess = make_postprocess(model)
+        response_cache.clear()
         app_state["is_ready"] = True
         logger.info("✅ Model loaded.")
     except Exception as e:
         logger.exception(f"❌ Failed to load model: {e}")
         app_state["is_ready"] = False
 
+# `gunicorn --preload` imports this module once in the master: loading the
+# model here lets forked workers share its pages copy-on-write
+if os.getenv("PRELOAD_MODEL"):
+    load_model()
+
+@asynccontextmanager
+async def lifespan(app):
+    global batch_queue, batch_task
+    setup_tracing()
+    batch_queue = asyncio.Queue()
+    batch_task = asyncio.create_task(batch_worker())
+    if model is None:
+        # in a thread so disk I/O + unpickling don't block the event loop
+        await asyncio.to_thread(load_model)
+
+    yield
+
+    batch_task.cancel()
+
+app = FastAPI(
+    title="Iris classifier with telemetry",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+
+# probe responses are built once: k8s hits these every few seconds per pod
+ALIVE_RESPONSE = Response(content=b'{"status":"alive"}', media_type="application/json")
+READY_RESPONSE = Response(content=b'{"status":"ready"}', media_type="application/json")
+NOT_ALIVE_RESPONSE = Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+NOT_READY_RESPONSE = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
 @app.get("/live_check")
 async def live_check():
     if app_state["is_alive"]:
-        return {"status": "alive"}
-    return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return ALIVE_RESPONSE
+    return NOT_ALIVE_RESPONSE
 
 @app.get("/ready_check")
 async def ready_check():
     if app_state["is_ready"]:
-        return {"status": "ready"}
-    return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return READY_RESPONSE
+    return NOT_READY_RESPONSE
 
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
+    start_ns = time.perf_counter_ns()
     resp = await call_next(request)
-    duration = round((time.time() - start_time) * 1000, 2)
+    duration = round((time.perf_counter_ns() - start_ns) / 1e6, 2)
     resp.headers["X-Process-Time-ms"] = str(duration)
     return resp
 
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    # FastAPI's default 422 echoes each bad input, which breaks on NaN/inf
+    errors = [
+        {**err, "input": str(err["input"])}
+        if isinstance(err.get("input"), float) and not math.isfinite(err["input"])
+        else err
+        for err in exc.errors()
+    ]
+    return ORJSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
+
 @app.exception_handler(Exception)
 async def exception_handler(request: Request, exc: Exception):
     span = trace.get_current_span()
     trace_id = format(span.get_span_context().trace_id, "032x")
-    logger.exception(json.dumps({
+    logger.exception("unhandled_exception", extra={
         "event": "unhandled_exception",
         "trace_id": trace_id,
         "path": str(request.url),
         "error": str(exc)
-    }))
-    return JSONResponse(
+    })
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "Internal Server Error", "trace_id": trace_id},
     )
@@ -97,29 +327,23 @@ async def exception_handler(request: Request, exc: Exception):
 @app.post("/predict")
 async def predict(input: Input, request: Request):
     with tracer.start_as_current_span("model_inference") as span:
-        start_time = time.time()
+        start_ns = time.perf_counter_ns()
         trace_id = format(span.get_span_context().trace_id, "032x")
 
         try:
             if model is None:
                 raise RuntimeError("Model not loaded")
 
-            features = [[
+            features = (
                 input.sepal_length,
                 input.sepal_width,
                 input.petal_length,
                 input.petal_width,
-            ]]
+            )
 
-            raw_pred = model.predict(features)[0]
+            species = await cached_predict(features)
 
-            # normalize output
-            if isinstance(raw_pred, str):
-                species = raw_pred
-            else:
-                species = SPECIES_MAP.get(int(raw_pred), str(raw_pred))
-
-            latency = round((time.time() - start_time) * 1000, 2)
+            latency = round((time.perf_counter_ns() - start_ns) / 1e6, 2)
 
             payload = {
                 "status": "success",
@@ -129,22 +353,71 @@ async def predict(input: Input, request: Request):
                 "trace_id": trace_id,
             }
 
-            logger.info(json.dumps({
-                "event": "prediction",
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("prediction", extra={
+                    "event": "prediction",
+                    "trace_id": trace_id,
+                    "input": features,
+                    "output": payload,
+                    "latency_ms": latency,
+                    "status": "success"
+                })
+
+            return payload
+
+        except Exception as e:
+            logger.exception("prediction_error", extra={
+                "event": "prediction_error",
                 "trace_id": trace_id,
-                "input": features,
-                "output": payload,
+                "error": str(e)
+            })
+            raise HTTPException(status_code=500, detail="Prediction failed")
+
+@app.post("/predict_batch")
+async def predict_batch(
+    items: Annotated[List[Input], Field(min_length=1, max_length=MAX_PREDICT_BATCH)],
+    request: Request,
+):
+    # callers that already hold many rows: one model.predict for the whole list
+    with tracer.start_as_current_span("model_inference_batch") as span:
+        start_ns = time.perf_counter_ns()
+        trace_id = format(span.get_span_context().trace_id, "032x")
+
+        try:
+            if model is None:
+                raise RuntimeError("Model not loaded")
+
+            X = rows_to_array([
+                (i.sepal_length, i.sepal_width, i.petal_length, i.petal_width) for i in items
+            ])
+            loop = asyncio.get_running_loop()
+            preds = await loop.run_in_executor(predict_executor, model.predict, X)
+            species = [postprocess(y) for y in preds]
+
+            latency = round((time.perf_counter_ns() - start_ns) / 1e6, 2)
+
+            payload = {
+                "status": "success",
+                "predictions": [{"predicted_label": s, "species": s} for s in species],
                 "latency_ms": latency,
-                "status": "success"
-            }))
+                "trace_id": trace_id,
+            }
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("prediction_batch", extra={
+                    "event": "prediction_batch",
+                    "trace_id": trace_id,
+                    "batch_size": len(items),
+                    "latency_ms": latency,
+                    "status": "success"
+                })
 
             return payload
 
         except Exception as e:
-            logger.exception(json.dumps({
+            logger.exception("prediction_error", extra={
                 "event": "prediction_error",
                 "trace_id": trace_id,
                 "error": str(e)
-            }))
+            })
             raise HTTPException(status_code=500, detail="Prediction failed")
-
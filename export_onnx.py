@@ -0,0 +1,40 @@
+"""
+Converts models/model.pkl to models/model.onnx for the onnxruntime backend in app.py.
+
+Run once after training / `dvc pull`:  python export_onnx.py
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import joblib
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+
+LOCAL_MODEL_PATH = Path("models/model.pkl")
+LOCAL_ONNX_PATH = Path("models/model.onnx")
+N_FEATURES = 4
+
+
+def main():
+    model = joblib.load(LOCAL_MODEL_PATH)
+    onx = convert_sklearn(
+        model,
+        initial_types=[("input", FloatTensorType([None, N_FEATURES]))],
+        # plain label/probability tensors instead of a list of dicts
+        options={id(model): {"zipmap": False}},
+    )
+    # keep classes_ so app.py can resolve labels without the sklearn model
+    meta = onx.metadata_props.add()
+    meta.key = "classes"
+    meta.value = json.dumps(model.classes_.tolist())
+    # app.py only serves the export if this matches the expected model MD5
+    meta = onx.metadata_props.add()
+    meta.key = "source_md5"
+    meta.value = hashlib.md5(LOCAL_MODEL_PATH.read_bytes()).hexdigest()
+    LOCAL_ONNX_PATH.write_bytes(onx.SerializeToString())
+    print("✅ ONNX model written →", LOCAL_ONNX_PATH)
+
+
+if __name__ == "__main__":
+    main()